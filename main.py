@@ -1,14 +1,29 @@
 from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
-import spotipy
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, RedirectResponse
+from spotipy.cache_handler import CacheHandler
 from spotipy.oauth2 import SpotifyOAuth
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, or_
+from cryptography.fernet import Fernet
+from sqlalchemy import (
+    Column, Integer, LargeBinary, String, ForeignKey, Index,
+    bindparam, delete, func, or_, select, text
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.orm import deferred, load_only, relationship, undefer_group
 import os
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager, suppress
+from cachetools import TTLCache
+import anyio
+import asyncio
+import httpx
 import logging
+import orjson
 import time
 
 # Load environment variables
@@ -17,8 +32,33 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+# App startup/shutdown: resources are opened in order and released in reverse
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create tables (development only; production schema is managed with migrations)
+    if os.getenv("AUTO_CREATE_TABLES") == "1":
+        async with engine.begin() as conn:
+            await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            await conn.run_sync(Base.metadata.create_all)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # Shared HTTP client so Spotify connections (and TLS sessions) are reused across requests
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+    app.state.top_artists_task = asyncio.create_task(refresh_top_artists_periodically())
+    try:
+        yield
+    finally:
+        app.state.top_artists_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await app.state.top_artists_task
+        await app.state.http.aclose()
+        await engine.dispose()
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -29,10 +69,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Database setup
-DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Compress larger responses (compare and top lists run to several KB of JSON)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Database setup (async driver: asyncpg)
+DATABASE_URL = os.getenv("DATABASE_URL").replace("postgresql://", "postgresql+asyncpg://", 1)
+# PgBouncer in transaction mode can't keep asyncpg's prepared statements on a server
+# connection, so both asyncpg's and SQLAlchemy's statement caches must be disabled
+PGBOUNCER_TRANSACTION_MODE = os.getenv("PGBOUNCER_TRANSACTION_MODE") == "1"
+if PGBOUNCER_TRANSACTION_MODE:
+    DATABASE_URL += ("&" if "?" in DATABASE_URL else "?") + "prepared_statement_cache_size=0"
+engine = create_async_engine(
+    DATABASE_URL,
+    connect_args={"statement_cache_size": 0} if PGBOUNCER_TRANSACTION_MODE else {},
+    pool_size=int(os.getenv("DB_POOL_SIZE", 20)),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=3600
+)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # Database models
@@ -41,9 +97,26 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, unique=True, index=True, nullable=True)
     spotify_id = Column(String, unique=True, index=True)
-    access_token = Column(String)
+    # Fernet-encrypted; only loaded (via undefer_group("tokens")) when a Spotify call is made
+    access_token = deferred(Column(LargeBinary), group="tokens", raiseload=True)
     expires_at = Column(Integer)
-    refresh_token = Column(String)
+    refresh_token = deferred(Column(LargeBinary), group="tokens", raiseload=True)
+
+    # Trigram indexes so the substring (ilike '%q%') user search can use an index
+    __table_args__ = (
+        Index(
+            "ix_users_spotify_id_trgm",
+            "spotify_id",
+            postgresql_using="gin",
+            postgresql_ops={"spotify_id": "gin_trgm_ops"}
+        ),
+        Index(
+            "ix_users_email_trgm",
+            "email",
+            postgresql_using="gin",
+            postgresql_ops={"email": "gin_trgm_ops"}
+        ),
+    )
 
     connections = relationship(
         "Connection",
@@ -58,40 +131,349 @@ class Connection(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     connected_user_id = Column(Integer, ForeignKey("users.id"))
 
+    __table_args__ = (
+        Index("ix_conn_user_conn", "user_id", "connected_user_id", unique=True),
+    )
+
     user = relationship(
         "User",
         back_populates="connections",
         foreign_keys=[user_id]
     )
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+# Top artist IDs per user, synced from Spotify and used for link suggestions
+class UserTopArtist(Base):
+    __tablename__ = "user_top_artists"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    artist_id = Column(String, primary_key=True, index=True)
+
+# Last run time of background jobs, used to coordinate them across workers
+class SyncState(Base):
+    __tablename__ = "sync_state"
+    name = Column(String, primary_key=True)
+    last_run_at = Column(Integer)
+
+# Hot-path statements, built once with bind parameters so each request reuses the
+# same statement object and its cached compiled SQL (IN lists use expanding params)
+USER_BY_SPOTIFY_ID = select(User).where(User.spotify_id == bindparam("spotify_id"))
+
+USERS_WITH_TOKENS_BY_IDS = (
+    select(User)
+    .options(undefer_group("tokens"))
+    .where(User.id.in_(bindparam("user_ids", expanding=True)))
+)
+
+SEARCH_USERS = (
+    select(User)
+    .options(load_only(User.id, User.spotify_id, User.email))
+    .where(
+        or_(
+            User.spotify_id.ilike(bindparam("pattern")),
+            User.email.ilike(bindparam("pattern"))
+        )
+    )
+    .offset(bindparam("offset", type_=Integer))
+    .limit(bindparam("limit", type_=Integer))
+)
+
+_shared_artist_count = func.count().label("shared_artist_count")
+SUGGESTED_LINKS = (
+    select(User.id, User.spotify_id, _shared_artist_count)
+    .join(UserTopArtist, UserTopArtist.user_id == User.id)
+    .where(
+        UserTopArtist.artist_id.in_(
+            select(UserTopArtist.artist_id).where(UserTopArtist.user_id == bindparam("user_id"))
+        ),
+        User.id != bindparam("user_id")
+    )
+    .group_by(User.id, User.spotify_id)
+    .order_by(_shared_artist_count.desc())
+)
+
+LINKED_USERS = (
+    select(User)
+    .options(load_only(User.id, User.spotify_id, User.email))
+    .join(Connection, Connection.connected_user_id == User.id)
+    .where(Connection.user_id == bindparam("user_id"))
+)
+
+# spotipy's default cache handler keeps one token file shared by every user, so a login
+# could be handed someone else's cached token; tokens are stored per user in the DB instead
+class NoCacheHandler(CacheHandler):
+    def get_cached_token(self):
+        return None
+
+    def save_token_to_cache(self, token_info):
+        pass
 
 # Spotify OAuth setup
 sp_oauth = SpotifyOAuth(
     client_id=os.getenv("SPOTIFY_CLIENT_ID"),
     client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
     redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI"),
-    scope="user-top-read user-read-private user-read-email"
+    scope="user-top-read user-read-private user-read-email",
+    cache_handler=NoCacheHandler()
 )
 
+# Token encryption
+TOKEN_ENCRYPTION_KEY = os.getenv("TOKEN_ENCRYPTION_KEY")
+if not TOKEN_ENCRYPTION_KEY:
+    raise RuntimeError(
+        "TOKEN_ENCRYPTION_KEY is not set; generate one with "
+        "cryptography.fernet.Fernet.generate_key()"
+    )
+fernet = Fernet(TOKEN_ENCRYPTION_KEY)
+
+def encrypt_token(token: str):
+    return fernet.encrypt(token.encode())
+
+def decrypt_token(token: bytes):
+    return fernet.decrypt(token).decode()
+
+# spotipy's OAuth client is blocking, so its calls run in the threadpool; raise the
+# default limit of 40 threads so a burst of logins/refreshes doesn't queue behind it
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", 200))
+
+# Spotify Web API settings
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+SPOTIFY_MAX_CONCURRENCY = 10
+TOP_ARTISTS_REFRESH_INTERVAL = int(os.getenv("TOP_ARTISTS_REFRESH_INTERVAL", 3600))
+# How often each worker checks whether the top artists sync is due
+TOP_ARTISTS_SYNC_POLL_INTERVAL = 60
+
+# Short-lived cache of Spotify top tracks/artists, keyed by (user_id, kind, limit, time_range)
+TOP_ITEMS_CACHE = TTLCache(maxsize=10_000, ttl=300)
+
+# Last ETag and (trimmed) body per Spotify request, keyed by (token, path, params), so
+# repeat requests can be sent conditionally. Entries are dropped an hour after they are
+# stored; a refreshed token starts new keys. A trimmed 50-item top list is on the order
+# of 100 KB of Python objects, so the size bound keeps this to a few hundred MB per worker.
+SPOTIFY_ETAGS = TTLCache(maxsize=2_000, ttl=3600)
+
 # Dependency to get a database session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
-
-# Helper to refresh tokens
-def get_spotify_client(user: User, db: Session):
-    if user.expires_at and user.expires_at - int(time.time()) < 60:
-        token_info = sp_oauth.refresh_access_token(user.refresh_token)
-        user.access_token = token_info["access_token"]
-        user.refresh_token = token_info["refresh_token"]
-        user.expires_at = token_info["expires_at"]
-        db.commit()
-    return spotipy.Spotify(auth=user.access_token)
+
+# Helpers to refresh tokens
+def needs_refresh(user: User):
+    return bool(user.expires_at) and user.expires_at - int(time.time()) < 60
+
+def apply_refresh(user: User, token_info: dict):
+    user.access_token = encrypt_token(token_info["access_token"])
+    user.refresh_token = encrypt_token(token_info["refresh_token"])
+    user.expires_at = token_info["expires_at"]
+
+async def refresh_access_token(refresh_token: str):
+    return await run_in_threadpool(sp_oauth.refresh_access_token, refresh_token)
+
+async def get_fresh_token(user: User, db: AsyncSession):
+    # Tokens are cleared when the schema is migrated to encrypted storage
+    if not user.access_token or not user.refresh_token:
+        raise HTTPException(status_code=401, detail="Spotify authorization missing, please log in again")
+    if needs_refresh(user):
+        apply_refresh(user, await refresh_access_token(decrypt_token(user.refresh_token)))
+        await db.commit()
+    return decrypt_token(user.access_token)
+
+# Refresh all expired tokens concurrently with a single commit; returns IDs that failed
+async def refresh_expired_tokens(users: list, db: AsyncSession):
+    to_refresh = [user for user in users if needs_refresh(user)]
+    if not to_refresh:
+        return set()
+    semaphore = asyncio.Semaphore(SPOTIFY_MAX_CONCURRENCY)
+
+    async def refresh(user: User):
+        async with semaphore:
+            return await refresh_access_token(decrypt_token(user.refresh_token))
+
+    results = await asyncio.gather(*(refresh(user) for user in to_refresh), return_exceptions=True)
+    failed = set()
+    for user, token_info in zip(to_refresh, results):
+        if isinstance(token_info, Exception):
+            logging.warning(f"Error refreshing token for user {user.id}: {token_info}")
+            failed.add(user.id)
+        else:
+            apply_refresh(user, token_info)
+    await db.commit()
+    return failed
+
+# Trim Spotify top-list items to the fields the handlers read; raw tracks carry
+# available_markets lists on both the track and its album
+def slim_track(track: dict):
+    return {
+        "id": track["id"],
+        "name": track["name"],
+        "artists": [{"name": artist["name"]} for artist in track["artists"]],
+        "album": {"name": track["album"]["name"], "images": track["album"]["images"][:1]},
+        "external_urls": {"spotify": track["external_urls"]["spotify"]}
+    }
+
+def slim_artist(artist: dict):
+    return {
+        "id": artist["id"],
+        "name": artist["name"],
+        "genres": artist.get("genres", []),
+        "popularity": artist["popularity"],
+        "images": artist["images"][:1],
+        "external_urls": {"spotify": artist["external_urls"]["spotify"]}
+    }
+
+SLIM_TOP_ITEM = {"tracks": slim_track, "artists": slim_artist}
+
+# Helper to call the Spotify Web API; `slim` trims the body before it is cached and returned
+async def spotify_get(path: str, token: str, params: dict = None, slim=None):
+    key = (token, path, tuple(sorted(params.items())) if params else ())
+    cached = SPOTIFY_ETAGS.get(key)
+    headers = {"Authorization": f"Bearer {token}"}
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    response = await app.state.http.get(f"{SPOTIFY_API_URL}{path}", headers=headers, params=params)
+    if response.status_code == 304 and cached:
+        return cached[1]
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    if slim:
+        data = slim(data)
+    etag = response.headers.get("ETag")
+    if etag:
+        SPOTIFY_ETAGS[key] = (etag, data)
+    return data
+
+# Helper to fetch a user's top tracks or artists, served from the cache when fresh
+async def get_top_items(
+    user_id: int,
+    token: str,
+    kind: str,
+    limit: int = 50,
+    time_range: str = "medium_term"
+):
+    key = (user_id, kind, limit, time_range)
+    if key in TOP_ITEMS_CACHE:
+        return TOP_ITEMS_CACHE[key]
+    slim_item = SLIM_TOP_ITEM[kind]
+    data = await spotify_get(
+        f"/me/top/{kind}",
+        token,
+        {"limit": limit, "time_range": time_range},
+        slim=lambda body: {"items": [slim_item(item) for item in body["items"]]}
+    )
+    items = TOP_ITEMS_CACHE[key] = data["items"]
+    return items
+
+# Request-scoped loader for one user's Spotify data. Concurrent and repeated lookups
+# share a single in-flight call, and every top-list limit is served from one full fetch.
+class SpotifyLoader:
+    def __init__(self, user_id: int, token: str):
+        self.user_id = user_id
+        self.token = token
+        self._tasks = {}
+
+    def _load(self, key: tuple, fetch):
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(fetch())
+        return self._tasks[key]
+
+    async def profile(self):
+        return await self._load(("profile",), lambda: spotify_get("/me", self.token))
+
+    async def top_items(self, kind: str, limit: int = 50, time_range: str = "medium_term"):
+        items = await self._load(
+            (kind, time_range),
+            lambda: get_top_items(self.user_id, self.token, kind, time_range=time_range)
+        )
+        return items[:limit]
+
+# Helper to fetch a user's top artist IDs from their stored (encrypted) token, bounded by
+# a shared semaphore; decryption happens here so a bad row fails only for that user
+async def fetch_top_artist_ids(
+    user_id: int,
+    encrypted_token: bytes,
+    semaphore: asyncio.Semaphore
+):
+    token = decrypt_token(encrypted_token)
+    async with semaphore:
+        artists = await get_top_items(user_id, token, "artists")
+    return {artist["id"] for artist in artists}
+
+# Helper to replace a user's stored top artist IDs (caller commits). Only rows that
+# changed are touched, and the upsert tolerates a concurrent writer for the same user.
+async def store_top_artist_ids(db: AsyncSession, user_id: int, artist_ids: set):
+    await db.execute(
+        delete(UserTopArtist).where(
+            UserTopArtist.user_id == user_id,
+            UserTopArtist.artist_id.not_in(list(artist_ids))
+        )
+    )
+    if artist_ids:
+        await db.execute(
+            pg_insert(UserTopArtist)
+            .values([{"user_id": user_id, "artist_id": artist_id} for artist_id in artist_ids])
+            .on_conflict_do_nothing(index_elements=["user_id", "artist_id"])
+        )
+
+# Refresh every user's stored top artists from Spotify, committing per user so one
+# failure doesn't discard the rest of the sync
+async def refresh_top_artists():
+    async with SessionLocal() as db:
+        result = await db.execute(
+            select(User).options(undefer_group("tokens")).where(User.access_token.is_not(None))
+        )
+        users = result.scalars().all()
+        failed = await refresh_expired_tokens(users, db)
+        users = [user for user in users if user.id not in failed]
+        # Read IDs up front; a rollback below expires the loaded users
+        user_ids = [user.id for user in users]
+        semaphore = asyncio.Semaphore(SPOTIFY_MAX_CONCURRENCY)
+        results = await asyncio.gather(
+            *(
+                fetch_top_artist_ids(user.id, user.access_token, semaphore)
+                for user in users
+            ),
+            return_exceptions=True
+        )
+        for user_id, artist_ids in zip(user_ids, results):
+            if isinstance(artist_ids, Exception):
+                logging.warning(f"Error fetching data for user {user_id}: {artist_ids}")
+                continue
+            try:
+                await store_top_artist_ids(db, user_id, artist_ids)
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                logging.warning(f"Error storing top artists for user {user_id}: {e}")
+
+# Claim the next top artists sync. The upsert only updates the sync_state row once the
+# last run is older than the interval, and row locking lets exactly one worker win. It
+# is a single statement with no session state, so it also works behind PgBouncer in
+# transaction mode.
+async def claim_top_artists_sync():
+    now = int(time.time())
+    async with SessionLocal() as db:
+        result = await db.execute(
+            pg_insert(SyncState)
+            .values(name="top_artists", last_run_at=now)
+            .on_conflict_do_update(
+                index_elements=["name"],
+                set_={"last_run_at": now},
+                where=SyncState.last_run_at <= now - TOP_ARTISTS_REFRESH_INTERVAL
+            )
+            .returning(SyncState.name)
+        )
+        claimed = result.first() is not None
+        await db.commit()
+    return claimed
+
+# Background sync loop. Every worker polls, and whichever claims an overdue run syncs.
+# Boots only trigger a sync when one is due, and restarted workers still pick it up.
+async def refresh_top_artists_periodically():
+    while True:
+        try:
+            if await claim_top_artists_sync():
+                await refresh_top_artists()
+        except Exception as e:
+            logging.warning(f"Error refreshing top artists: {e}")
+        await asyncio.sleep(TOP_ARTISTS_SYNC_POLL_INTERVAL)
 
 # Root endpoint
 @app.get("/")
@@ -112,38 +494,43 @@ async def logout():
 
 # Callback endpoint
 @app.get("/callback")
-async def callback(code: str, db: Session = Depends(get_db)):
+async def callback(code: str, db: AsyncSession = Depends(get_db)):
     try:
-        token_info = sp_oauth.get_access_token(code)
-        sp = spotipy.Spotify(auth=token_info["access_token"])
-        user_info = sp.current_user()
-        user = db.query(User).filter(User.spotify_id == user_info["id"]).first()
+        token_info = await run_in_threadpool(
+            sp_oauth.get_access_token, code, as_dict=True, check_cache=False
+        )
+        user_info = await spotify_get("/me", token_info["access_token"])
+        result = await db.execute(USER_BY_SPOTIFY_ID, {"spotify_id": user_info["id"]})
+        user = result.scalar_one_or_none()
         if not user:
             user = User(
                 spotify_id=user_info["id"],
-                access_token=token_info["access_token"],
-                refresh_token=token_info["refresh_token"],
-                expires_at=token_info["expires_at"],
                 email=user_info.get("email")
             )
             db.add(user)
-        else:
-            user.access_token = token_info["access_token"]
-            user.refresh_token = token_info["refresh_token"]
-            user.expires_at = token_info["expires_at"]
-        db.commit()
-        return {"message": "Successfully authenticated", "user_id": user.id}
+        apply_refresh(user, token_info)
+        await db.commit()
+        # Read the ID now; a rollback below expires the loaded user
+        user_id = user.id
+        try:
+            artists = await get_top_items(user_id, token_info["access_token"], "artists")
+            await store_top_artist_ids(db, user_id, {artist["id"] for artist in artists})
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logging.warning(f"Error syncing top artists for user {user_id}: {e}")
+        return {"message": "Successfully authenticated", "user_id": user_id}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # Get top tracks
 @app.get("/top-tracks")
-async def get_top_tracks(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def get_top_tracks(user_id: int, db: AsyncSession = Depends(get_db)):
+    user = await db.get(User, user_id, options=[undefer_group("tokens")])
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    sp = get_spotify_client(user, db)
-    top_tracks_raw = sp.current_user_top_tracks(limit=50, time_range="medium_term")
+    token = await get_fresh_token(user, db)
+    top_tracks = await get_top_items(user.id, token, "tracks")
     return {
         "tracks": [
             {
@@ -153,18 +540,18 @@ async def get_top_tracks(user_id: int, db: Session = Depends(get_db)):
                 "spotify_url": track["external_urls"]["spotify"],
                 "album_image": track["album"]["images"][0]["url"]
             }
-            for track in top_tracks_raw["items"]
+            for track in top_tracks
         ]
     }
 
 # Get top artists
 @app.get("/top-artists")
-async def get_top_artists(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def get_top_artists(user_id: int, db: AsyncSession = Depends(get_db)):
+    user = await db.get(User, user_id, options=[undefer_group("tokens")])
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    sp = get_spotify_client(user, db)
-    top_artists_raw = sp.current_user_top_artists(limit=50, time_range="medium_term")
+    token = await get_fresh_token(user, db)
+    top_artists = await get_top_items(user.id, token, "artists")
     return {
         "artists": [
             {
@@ -174,7 +561,7 @@ async def get_top_artists(user_id: int, db: Session = Depends(get_db)):
                 "spotify_url": artist["external_urls"]["spotify"],
                 "image": artist["images"][0]["url"] if artist["images"] else None
             }
-            for artist in top_artists_raw["items"]
+            for artist in top_artists
         ]
     }
 
@@ -184,14 +571,12 @@ async def search_users(
     q: str,
     limit: int = 10,
     offset: int = 0,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    users = db.query(User).filter(
-        or_(
-            User.spotify_id.ilike(f"%{q}%"),
-            User.email.ilike(f"%{q}%")
-        )
-    ).offset(offset).limit(limit).all()
+    result = await db.execute(
+        SEARCH_USERS, {"pattern": f"%{q}%", "offset": offset, "limit": limit}
+    )
+    users = result.scalars().all()
 
     return [
         {"id": u.id, "spotify_id": u.spotify_id, "email": u.email}
@@ -200,38 +585,40 @@ async def search_users(
 
 # Suggest connections
 @app.get("/suggested-links/{user_id}")
-async def suggest_links(user_id: int, db: Session = Depends(get_db)):
-    current_user = db.query(User).filter(User.id == user_id).first()
+async def suggest_links(user_id: int, db: AsyncSession = Depends(get_db)):
+    current_user = await db.get(User, user_id, options=[load_only(User.id)])
     if not current_user:
         raise HTTPException(status_code=404, detail="User not found")
-    sp_current = get_spotify_client(current_user, db)
-    current_artist_ids = {
-        artist["id"] for artist in sp_current.current_user_top_artists(limit=50)["items"]
-    }
-    suggestions = []
-    for user in db.query(User).filter(User.id != user_id).all():
-        try:
-            sp = get_spotify_client(user, db)
-            artists = sp.current_user_top_artists(limit=50)["items"]
-            overlap = len(current_artist_ids & {a["id"] for a in artists})
-            if overlap > 0:
-                suggestions.append({
-                    "id": user.id,
-                    "spotify_id": user.spotify_id,
-                    "shared_artist_count": overlap
-                })
-        except Exception as e:
-            logging.warning(f"Error fetching data for user {user.id}: {e}")
-            continue
-    suggestions.sort(key=lambda s: s["shared_artist_count"], reverse=True)
-    return suggestions
+    result = await db.execute(SUGGESTED_LINKS, {"user_id": user_id})
+    return [
+        {"id": row.id, "spotify_id": row.spotify_id, "shared_artist_count": row.shared_artist_count}
+        for row in result
+    ]
+
+# Connect users endpoint (links are mutual)
+@app.post("/connect/{user_id}/{connected_user_id}")
+async def connect_users(user_id: int, connected_user_id: int, db: AsyncSession = Depends(get_db)):
+    if user_id == connected_user_id:
+        raise HTTPException(status_code=400, detail="Cannot connect a user to themselves")
+    stmt = pg_insert(Connection).values([
+        {"user_id": user_id, "connected_user_id": connected_user_id},
+        {"user_id": connected_user_id, "connected_user_id": user_id}
+    ]).on_conflict_do_nothing(index_elements=["user_id", "connected_user_id"])
+    try:
+        result = await db.execute(stmt)
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=404, detail="One or both users not found")
+    if result.rowcount == 0:
+        return {"message": "Users already connected"}
+    return {"message": "Users connected"}
 
 # Get linked users (Users that the current user is connected with)
 @app.get("/linked-users/{user_id}")
-async def get_linked_users(user_id: int, db: Session = Depends(get_db)):
-    connections = db.query(Connection).filter(Connection.user_id == user_id).all()
-    linked_user_ids = [conn.connected_user_id for conn in connections]
-    linked_users = db.query(User).filter(User.id.in_(linked_user_ids)).all()
+async def get_linked_users(user_id: int, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(LINKED_USERS, {"user_id": user_id})
+    linked_users = result.scalars().all()
     return [
         {"id": user.id, "spotify_id": user.spotify_id, "email": user.email}
         for user in linked_users
@@ -239,13 +626,17 @@ async def get_linked_users(user_id: int, db: Session = Depends(get_db)):
 
 # User profile endpoint
 @app.get("/profile/{user_id}")
-async def user_profile(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def user_profile(user_id: int, db: AsyncSession = Depends(get_db)):
+    user = await db.get(User, user_id, options=[undefer_group("tokens")])
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    sp = get_spotify_client(user, db)
-    top_artist = sp.current_user_top_artists(limit=1)["items"][0]
-    top_track = sp.current_user_top_tracks(limit=1)["items"][0]
+    loader = SpotifyLoader(user.id, await get_fresh_token(user, db))
+    top_artists, top_tracks = await asyncio.gather(
+        loader.top_items("artists", limit=1),
+        loader.top_items("tracks", limit=1)
+    )
+    top_artist = top_artists[0]
+    top_track = top_tracks[0]
     return {
         "id": user.id,
         "spotify_id": user.spotify_id,
@@ -264,42 +655,49 @@ async def user_profile(user_id: int, db: Session = Depends(get_db)):
 
 # Compare users endpoint
 @app.get("/compare/{user_id}/{connected_user_id}")
-async def compare_users(user_id: int, connected_user_id: int, db: Session = Depends(get_db)):
-    user1 = db.query(User).filter(User.id == user_id).first()
-    user2 = db.query(User).filter(User.id == connected_user_id).first()
+async def compare_users(user_id: int, connected_user_id: int, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(USERS_WITH_TOKENS_BY_IDS, {"user_ids": [user_id, connected_user_id]})
+    users = {u.id: u for u in result.scalars().all()}
+    user1 = users.get(user_id)
+    user2 = users.get(connected_user_id)
     if not user1 or not user2:
         raise HTTPException(status_code=404, detail="One or both users not found")
-    sp1 = get_spotify_client(user1, db)
-    sp2 = get_spotify_client(user2, db)
-
-    profile1 = sp1.current_user()
-    profile2 = sp2.current_user()
+    loader1 = SpotifyLoader(user1.id, await get_fresh_token(user1, db))
+    loader2 = SpotifyLoader(user2.id, await get_fresh_token(user2, db))
+
+    profile1, profile2, tracks1, tracks2, artists1, artists2 = await asyncio.gather(
+        loader1.profile(),
+        loader2.profile(),
+        loader1.top_items("tracks"),
+        loader2.top_items("tracks"),
+        loader1.top_items("artists"),
+        loader2.top_items("artists")
+    )
 
-    top_artist1 = sp1.current_user_top_artists(limit=1)["items"][0]
-    top_artist2 = sp2.current_user_top_artists(limit=1)["items"][0]
-    top_track1 = sp1.current_user_top_tracks(limit=1)["items"][0]
-    top_track2 = sp2.current_user_top_tracks(limit=1)["items"][0]
+    top_track1 = tracks1[0]
+    top_track2 = tracks2[0]
+    top_artist1 = artists1[0]
+    top_artist2 = artists2[0]
 
-    user1_tracks = {t["id"]: t for t in sp1.current_user_top_tracks(limit=50)["items"]}
-    user2_track_ids = {t["id"] for t in sp2.current_user_top_tracks(limit=50)["items"]}
-    shared_track_ids = user1_tracks.keys() & user2_track_ids
+    user2_track_ids = {t["id"] for t in tracks2}
+    # Iterate user1's list so shared items keep user1's ranking order
+    shared_tracks = [t for t in tracks1 if t["id"] in user2_track_ids]
 
     common_tracks = [{
         "name": t["name"],
         "artist": t["artists"][0]["name"],
         "spotify_url": t["external_urls"]["spotify"],
         "album_image": t["album"]["images"][0]["url"] if t["album"]["images"] else None
-    } for tid, t in user1_tracks.items() if tid in shared_track_ids]
+    } for t in shared_tracks]
 
-    user1_artists = {a["id"]: a for a in sp1.current_user_top_artists(limit=50)["items"]}
-    user2_artist_ids = {a["id"] for a in sp2.current_user_top_artists(limit=50)["items"]}
-    shared_artist_ids = user1_artists.keys() & user2_artist_ids
+    user2_artist_ids = {a["id"] for a in artists2}
+    shared_artists = [a for a in artists1 if a["id"] in user2_artist_ids]
 
     common_artists = [{
         "name": a["name"],
         "spotify_url": a["external_urls"]["spotify"],
         "image": a["images"][0]["url"] if a["images"] else None
-    } for aid, a in user1_artists.items() if aid in shared_artist_ids]
+    } for a in shared_artists]
 
     return {
         "user1": {